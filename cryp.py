@@ -1,23 +1,37 @@
 # Import necessary libraries
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for
+from flask.json.provider import JSONProvider
 from coinbase_commerce.client import Client
 from coinbase_commerce.webhook import Webhook
 from dotenv import load_dotenv
 import os
 import qrcode
+import qrcode.image.svg
 from io import BytesIO
-import requests
+import redis
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+import threading
+import atexit
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import json
-from functools import wraps
+import orjson
+import sqlite3
+from functools import wraps, lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
 import pandas as pd
 import logging
 from logging.handlers import RotatingFileHandler
-import jwt
 import hashlib
+import hmac
+import cachetools
+import cachetools.func
+import base64
 import time
-from typing import Dict, List, Optional, Union
-from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from dataclasses import dataclass, asdict
 from enum import Enum
 
 # Load environment variables
@@ -34,16 +48,133 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# JSON provider backed by orjson for request parsing and jsonify responses
+class OrjsonProvider(JSONProvider):
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'your-secret-key-here')
 
+# HTTP adapter that applies a default (connect, read) timeout to every request
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, *args, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
 # Initialize Coinbase Commerce client
 client = Client(api_key=os.getenv('COINBASE_API_KEY'))
+COINBASE_POOL_SIZE = 32  # Concurrent Coinbase calls, and pooled connections to match
+COINBASE_REQUEST_TIMEOUT = (2, 10)  # (connect, read) seconds per HTTP request
+
+# The SDK sends every call through client.session without a timeout; give it
+# one so a hung Coinbase API cannot pin a pool thread, and size its connection
+# pool to the thread pool so concurrent charges reuse warm TLS connections
+# instead of opening new ones. Only connection failures are retried, so a
+# charge is never submitted twice.
+client.session.mount('https://', TimeoutHTTPAdapter(
+    timeout=COINBASE_REQUEST_TIMEOUT,
+    pool_connections=4,
+    pool_maxsize=COINBASE_POOL_SIZE,
+    max_retries=Retry(connect=3, read=0, backoff_factor=0.2)
+))
+
+# Thread pool for Coinbase API calls so charge creation can run concurrently
+coinbase_pool = ThreadPoolExecutor(max_workers=COINBASE_POOL_SIZE, thread_name_prefix='coinbase')
+COINBASE_TIMEOUT = 30  # Seconds to wait for Coinbase to create a charge
+BATCH_MAX_PAYMENTS = 50  # Maximum charges per /create_payments_batch request
 
 # Exchange rate API configuration
 EXCHANGE_RATE_API = "https://api.exchangerate-api.com/v4/latest/USD"
 CACHE_DURATION = 3600  # Cache duration in seconds (1 hour)
+RATE_RETRY_INTERVAL = 60  # Retry delay in seconds after a failed refresh
+EXCHANGE_RATE_RETRIES = 3  # Attempts per refresh on connection errors or gateway failures
+EXCHANGE_RATE_RETRY_STATUSES = {502, 503, 504}
+EXCHANGE_RATE_TIMEOUT = aiohttp.ClientTimeout(sock_connect=2, sock_read=5)
+
+# Supported fiat currencies
+SUPPORTED_CURRENCIES = {
+    'USD': {'name': 'US Dollar', 'symbol': '$'},
+    'EUR': {'name': 'Euro', 'symbol': '€'},
+    'GBP': {'name': 'British Pound', 'symbol': '£'},
+    'JPY': {'name': 'Japanese Yen', 'symbol': '¥'},
+    'CAD': {'name': 'Canadian Dollar', 'symbol': 'C$'},
+    'AUD': {'name': 'Australian Dollar', 'symbol': 'A$'},
+    'CHF': {'name': 'Swiss Franc', 'symbol': 'CHF'},
+    'CNY': {'name': 'Chinese Yuan', 'symbol': '¥'},
+    'INR': {'name': 'Indian Rupee', 'symbol': '₹'},
+    'SGD': {'name': 'Singapore Dollar', 'symbol': 'S$'}
+}
+
+# Supported cryptocurrencies
+SUPPORTED_CRYPTOS = {
+    'BTC': {'name': 'Bitcoin', 'symbol': '₿'},
+    'ETH': {'name': 'Ethereum', 'symbol': 'Ξ'},
+    'USDC': {'name': 'USD Coin', 'symbol': 'USDC'},
+    'LTC': {'name': 'Litecoin', 'symbol': 'Ł'},
+    'BCH': {'name': 'Bitcoin Cash', 'symbol': 'BCH'},
+    'XRP': {'name': 'XRP', 'symbol': 'XRP'},
+    'DOGE': {'name': 'Dogecoin', 'symbol': 'Ð'},
+    'DOT': {'name': 'Polkadot', 'symbol': 'DOT'},
+    'ADA': {'name': 'Cardano', 'symbol': '₳'},
+    'SOL': {'name': 'Solana', 'symbol': 'SOL'},
+    'AVAX': {'name': 'Avalanche', 'symbol': 'AVAX'},
+    'MATIC': {'name': 'Polygon', 'symbol': 'MATIC'},
+    'LINK': {'name': 'Chainlink', 'symbol': 'LINK'},
+    'UNI': {'name': 'Uniswap', 'symbol': 'UNI'},
+    'AAVE': {'name': 'Aave', 'symbol': 'AAVE'}
+}
+
+# This is a placeholder. In production, you would fetch real-time crypto rates
+# from a reliable API like Coinbase Pro or CoinGecko
+CRYPTO_RATES = {
+    'BTC': 50000.0,
+    'ETH': 3000.0,
+    'USDC': 1.0,
+    'LTC': 150.0,
+    'BCH': 500.0,
+    'XRP': 0.5,
+    'DOGE': 0.1,
+    'DOT': 20.0,
+    'ADA': 1.5,
+    'SOL': 100.0,
+    'AVAX': 50.0,
+    'MATIC': 2.0,
+    'LINK': 20.0,
+    'UNI': 10.0,
+    'AAVE': 200.0
+}
+
+# Payment storage configuration
+DATABASE_PATH = os.getenv('PAYMENTS_DB', 'payments.db')
+LEGACY_HISTORY_PATH = 'payment_history.json'
+HISTORY_PAGE_SIZE = 100  # Default number of payments per history page
+HISTORY_MAX_PAGE_SIZE = 1000  # Upper bound for the history page size
+
+# Redis client shared by all workers for rate limiting state
+redis_client = redis.Redis(
+    connection_pool=redis.ConnectionPool.from_url(
+        os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5
+    )
+)
 
 # Define enums for better type safety
 class PaymentStatus(Enum):
@@ -57,7 +188,7 @@ class CurrencyType(Enum):
     CRYPTO = "crypto"
 
 # Data class for payment information
-@dataclass
+@dataclass(slots=True, frozen=True)
 class PaymentInfo:
     id: str
     amount: float
@@ -70,19 +201,104 @@ class PaymentInfo:
     customer_email: Optional[str] = None
     description: Optional[str] = None
 
-# Cache for exchange rates
-exchange_rate_cache = {
-    'rates': {},
-    'timestamp': 0
-}
+# Latest (timestamp, rates) pair, published as one tuple so readers never see a torn update
+_rates_cache: Tuple[float, Dict[str, float]] = (0.0, {})
 
 # Rate limiting configuration
 RATE_LIMIT = {
-    'requests': 100,  # Maximum requests
-    'window': 3600,   # Time window in seconds (1 hour)
-    'ip_requests': {}  # Track requests per IP
+    'requests': 100,  # Bucket capacity (maximum burst of requests)
+    'window': 3600,   # Time window in seconds (1 hour) to refill a full bucket
+    # Token bucket per IP: ip -> (tokens, last_refill). Bounded so unique-IP floods
+    # evict the least recently seen buckets, which simply restart full.
+    'ip_requests': cachetools.LRUCache(maxsize=100_000)
 }
 
+# Guards the local buckets, which are shared by the worker's threads
+_local_bucket_lock = threading.Lock()
+
+# Atomic token bucket: refill, consume and persist in a single round trip
+# The clock is Redis' own TIME, so skew between app hosts cannot distort refills.
+TOKEN_BUCKET_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return allowed
+"""
+
+# After a Redis failure, use the local bucket for this long before trying Redis again
+REDIS_RETRY_AFTER = 30
+_redis_retry_at = 0.0
+_redis_outage = False
+
+# Load the token bucket script once at startup
+def load_token_bucket_script() -> Optional[str]:
+    global _redis_retry_at, _redis_outage
+    try:
+        return redis_client.script_load(TOKEN_BUCKET_SCRIPT)
+    except redis.RedisError as e:
+        logger.error(f"Error loading rate limit script, using local buckets: {str(e)}")
+        _redis_retry_at = time.time() + REDIS_RETRY_AFTER
+        _redis_outage = True
+        return None
+
+token_bucket_sha = load_token_bucket_script()
+
+# Raised when a session token fails verification
+class InvalidTokenError(Exception):
+    pass
+
+# Decode unpadded base64url as used in JWTs
+def base64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+# Verify an HS256 JWT with the given key and return its claims
+def verify_hs256(token: str, key: str) -> Dict:
+    try:
+        header, payload, signature = token.split('.')
+        expected = hmac.new(key.encode(), f'{header}.{payload}'.encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, base64url_decode(signature)):
+            raise InvalidTokenError('Signature verification failed')
+        header_data = orjson.loads(base64url_decode(header))
+        claims = orjson.loads(base64url_decode(payload))
+    except ValueError as e:
+        raise InvalidTokenError(f'Malformed token: {str(e)}') from e
+    if not isinstance(header_data, dict) or header_data.get('alg') != 'HS256':
+        raise InvalidTokenError('Unsupported token algorithm')
+    if not isinstance(claims, dict):
+        raise InvalidTokenError('Invalid token claims')
+    now = time.time()
+    if 'exp' in claims and now >= claims['exp']:
+        raise InvalidTokenError('Token has expired')
+    if 'nbf' in claims and now < claims['nbf']:
+        raise InvalidTokenError('Token is not yet valid')
+    return claims
+
+# Verified token claims, cached so repeat requests with the same token skip the HMAC check
+@cachetools.func.ttl_cache(maxsize=4096, ttl=60)
+def verify_token_cached(token: str) -> Dict:
+    return verify_hs256(token, app.secret_key)
+
+# Verify a session token, re-checking expiry since cached claims may outlive it
+def decode_token(token: str) -> Dict:
+    claims = verify_token_cached(token)
+    if 'exp' in claims and time.time() >= claims['exp']:
+        raise InvalidTokenError('Token has expired')
+    return claims
+
 # Authentication decorator
 def token_required(f):
     @wraps(f)
@@ -91,76 +307,266 @@ def token_required(f):
         if not token:
             return jsonify({'message': 'Token is missing'}), 401
         try:
-            data = jwt.decode(token, app.secret_key, algorithms=['HS256'])
+            data = decode_token(token)
             current_user = data['user']
-        except:
+        except (InvalidTokenError, KeyError, TypeError):
             return jsonify({'message': 'Token is invalid'}), 401
         return f(current_user, *args, **kwargs)
     return decorated
 
+# In-process token bucket, used when Redis is unavailable
+def consume_local_token(ip: str, now: float, cost: int = 1) -> bool:
+    capacity = RATE_LIMIT['requests']
+    refill_rate = capacity / RATE_LIMIT['window']
+    with _local_bucket_lock:
+        tokens, last_refill = RATE_LIMIT['ip_requests'].get(ip, (capacity, now))
+        tokens = min(capacity, tokens + (now - last_refill) * refill_rate)
+        if tokens < cost:
+            RATE_LIMIT['ip_requests'][ip] = (tokens, now)
+            return False
+        RATE_LIMIT['ip_requests'][ip] = (tokens - cost, now)
+        return True
+
+# Shared token bucket in Redis; falls back to the in-process bucket on errors.
+# After a failure Redis is skipped for REDIS_RETRY_AFTER seconds, so an outage
+# costs one socket timeout per interval rather than one per request.
+def consume_token(ip: str, now: float, cost: int = 1) -> bool:
+    global token_bucket_sha, _redis_retry_at, _redis_outage
+    if now < _redis_retry_at:
+        return consume_local_token(ip, now, cost)
+    args = (RATE_LIMIT['requests'], RATE_LIMIT['requests'] / RATE_LIMIT['window'], RATE_LIMIT['window'], cost)
+    try:
+        if token_bucket_sha is None:
+            token_bucket_sha = redis_client.script_load(TOKEN_BUCKET_SCRIPT)
+        try:
+            allowed = bool(redis_client.evalsha(token_bucket_sha, 1, f'rl:{ip}', *args))
+        except redis.exceptions.NoScriptError:
+            # Script cache was flushed (e.g. Redis restart); reload and retry once
+            token_bucket_sha = redis_client.script_load(TOKEN_BUCKET_SCRIPT)
+            allowed = bool(redis_client.evalsha(token_bucket_sha, 1, f'rl:{ip}', *args))
+    except redis.RedisError as e:
+        if not _redis_outage:
+            logger.warning(f"Redis rate limiting unavailable, using local buckets: {str(e)}")
+            _redis_outage = True
+        _redis_retry_at = now + REDIS_RETRY_AFTER
+        return consume_local_token(ip, now, cost)
+    if _redis_outage:
+        logger.info("Redis rate limiting restored")
+        _redis_outage = False
+    return allowed
+
 # Rate limiting decorator
 def rate_limit(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         ip = request.remote_addr
         current_time = time.time()
-        
-        # Clean up old entries
-        RATE_LIMIT['ip_requests'] = {
-            ip: timestamp for ip, timestamp in RATE_LIMIT['ip_requests'].items()
-            if current_time - timestamp < RATE_LIMIT['window']
-        }
-        
+
         # Check rate limit
-        if ip in RATE_LIMIT['ip_requests']:
-            if len(RATE_LIMIT['ip_requests'][ip]) >= RATE_LIMIT['requests']:
-                return jsonify({'error': 'Rate limit exceeded'}), 429
-            RATE_LIMIT['ip_requests'][ip].append(current_time)
-        else:
-            RATE_LIMIT['ip_requests'][ip] = [current_time]
-        
+        if not consume_token(ip, current_time):
+            return jsonify({'error': 'Rate limit exceeded'}), 429
+
         return f(*args, **kwargs)
     return decorated
 
-# Function to get exchange rates with caching
+# Fetch exchange rates, retrying transient failures with exponential backoff
+async def fetch_exchange_rates(http: aiohttp.ClientSession) -> Dict[str, float]:
+    for attempt in range(EXCHANGE_RATE_RETRIES):
+        try:
+            async with http.get(EXCHANGE_RATE_API) as response:
+                response.raise_for_status()
+                payload = await response.json()
+            return payload['rates']
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            retryable = (
+                not isinstance(e, aiohttp.ClientResponseError)
+                or e.status in EXCHANGE_RATE_RETRY_STATUSES
+            )
+            if not retryable or attempt == EXCHANGE_RATE_RETRIES - 1:
+                raise
+            await asyncio.sleep(0.2 * 2 ** attempt)
+
+# Background task that keeps the exchange rate snapshot fresh
+async def refresh_exchange_rates() -> None:
+    global _rates_cache
+    # One keep-alive session for the lifetime of the refresher
+    connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=CACHE_DURATION + 60)
+    async with aiohttp.ClientSession(connector=connector, timeout=EXCHANGE_RATE_TIMEOUT) as http:
+        while True:
+            try:
+                rates = await fetch_exchange_rates(http)
+                _rates_cache = (time.time(), rates)
+                delay = CACHE_DURATION
+            except Exception as e:
+                logger.error(f"Error fetching exchange rates: {str(e)}")
+                delay = RATE_RETRY_INTERVAL
+            await asyncio.sleep(delay)
+
+# Start the exchange rate refresher on a daemon thread
+def start_exchange_rate_refresher() -> threading.Thread:
+    thread = threading.Thread(
+        target=lambda: asyncio.run(refresh_exchange_rates()),
+        name='exchange-rate-refresher',
+        daemon=True
+    )
+    thread.start()
+    return thread
+
+# Function to get exchange rates without blocking on the network. The result
+# is empty until the refresher's first fetch succeeds.
 def get_exchange_rates() -> Dict[str, float]:
-    current_time = time.time()
-    if current_time - exchange_rate_cache['timestamp'] < CACHE_DURATION:
-        return exchange_rate_cache['rates']
-    
-    try:
-        response = requests.get(EXCHANGE_RATE_API)
-        rates = response.json()['rates']
-        exchange_rate_cache['rates'] = rates
-        exchange_rate_cache['timestamp'] = current_time
-        return rates
-    except Exception as e:
-        logger.error(f"Error fetching exchange rates: {str(e)}")
-        return exchange_rate_cache['rates']  # Return cached rates if available
+    _, rates = _rates_cache
+    return rates
+
+# Columns stored for each payment, in table order
+PAYMENT_COLUMNS = (
+    'id', 'amount', 'currency', 'crypto', 'status', 'timestamp', 'payment_url',
+    'exchange_rate', 'customer_email', 'description', 'completed_at'
+)
+
+# Upsert statement for a full payment row
+SAVE_PAYMENT_SQL = (
+    f"INSERT OR REPLACE INTO payments ({', '.join(PAYMENT_COLUMNS)}) "
+    f"VALUES ({', '.join(':' + column for column in PAYMENT_COLUMNS)})"
+)
 
-# Function to load payment history with error handling
-def load_payment_history() -> List[Dict]:
+# One SQLite connection per process, shared behind a lock. Under gevent,
+# threading.local is greenlet-local, so per-thread connections would mean one
+# connection per request; SQLite calls block the hub anyway, so a single
+# connection costs no concurrency.
+_db_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.RLock()
+
+# Context manager that holds the shared SQLite connection for one operation
+@contextmanager
+def get_db() -> Iterator[sqlite3.Connection]:
+    global _db_conn
+    with _db_lock:
+        if _db_conn is None:
+            conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            _db_conn = conn
+        yield _db_conn
+
+# Function to close the shared SQLite connection, used at shutdown
+def close_db() -> None:
+    global _db_conn
+    with _db_lock:
+        if _db_conn is not None:
+            _db_conn.close()
+            _db_conn = None
+
+# Function to create the payments table and import any legacy JSON history
+def init_db() -> None:
+    with get_db() as conn:
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS payments (
+                    id TEXT PRIMARY KEY,
+                    amount REAL,
+                    currency TEXT,
+                    crypto TEXT,
+                    status TEXT,
+                    timestamp TEXT,
+                    payment_url TEXT,
+                    exchange_rate REAL,
+                    customer_email TEXT,
+                    description TEXT,
+                    completed_at TEXT
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_payments_timestamp_id ON payments (timestamp, id)')
+        import_legacy_history(conn)
+
+# Function to convert a payment_history.json entry to the current row format.
+# That file was written with json.dump(default=str), so statuses look like
+# "PaymentStatus.PENDING" and datetimes use a space instead of "T".
+def normalize_legacy_payment(payment: Dict) -> Dict:
+    row = {column: payment.get(column) for column in PAYMENT_COLUMNS}
+    status = row['status']
+    if isinstance(status, str) and status.startswith('PaymentStatus.'):
+        try:
+            row['status'] = PaymentStatus[status.split('.', 1)[1]].value
+        except KeyError:
+            pass
+    for column in ('timestamp', 'completed_at'):
+        if isinstance(row[column], str):
+            try:
+                row[column] = datetime.fromisoformat(row[column]).isoformat()
+            except ValueError:
+                pass
+    return row
+
+# Function to copy payment_history.json into an empty payments table
+def import_legacy_history(conn: sqlite3.Connection) -> None:
+    if not os.path.exists(LEGACY_HISTORY_PATH):
+        return
+    if conn.execute('SELECT 1 FROM payments LIMIT 1').fetchone():
+        return
     try:
-        with open('payment_history.json', 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
-    except json.JSONDecodeError:
-        logger.error("Error decoding payment history file")
-        return []
-    except Exception as e:
+        with open(LEGACY_HISTORY_PATH, 'rb') as f:
+            history = orjson.loads(f.read())
+        rows = [normalize_legacy_payment(payment) for payment in history if payment.get('id')]
+        with conn:
+            conn.executemany(SAVE_PAYMENT_SQL, rows)
+        logger.info(f"Imported {len(rows)} payments from {LEGACY_HISTORY_PATH}")
+    except (OSError, orjson.JSONDecodeError, sqlite3.Error) as e:
+        logger.error(f"Error importing legacy payment history: {str(e)}")
+
+# Function to load a page of payment history, newest first. Passing the
+# (timestamp, id) of the last payment seen as `before` seeks straight to the
+# next page through the index instead of skipping `offset` rows; the id breaks
+# ties between payments that share a timestamp.
+def load_payment_history(limit: int = HISTORY_PAGE_SIZE, offset: int = 0,
+                         before: Optional[Tuple[str, str]] = None) -> List[Dict]:
+    try:
+        with get_db() as conn:
+            if before is not None:
+                cursor = conn.execute(
+                    'SELECT * FROM payments WHERE (timestamp, id) < (?, ?) '
+                    'ORDER BY timestamp DESC, id DESC LIMIT ?',
+                    (*before, limit)
+                )
+            else:
+                cursor = conn.execute(
+                    'SELECT * FROM payments ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?',
+                    (limit, offset)
+                )
+            return [dict(row) for row in cursor]
+    except sqlite3.Error as e:
         logger.error(f"Error loading payment history: {str(e)}")
         return []
 
-# Function to save payment history with error handling
-def save_payment_history(history: List[Dict]) -> bool:
+# Function to load a single payment by id
+def load_payment(payment_id: str) -> Optional[Dict]:
     try:
-        with open('payment_history.json', 'w') as f:
-            json.dump(history, f, default=str)
-        return True
-    except Exception as e:
-        logger.error(f"Error saving payment history: {str(e)}")
-        return False
+        with get_db() as conn:
+            row = conn.execute('SELECT * FROM payments WHERE id = ?', (payment_id,)).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Error loading payment {payment_id}: {str(e)}")
+        return None
+
+# Function to save a single payment. One INSERT in WAL mode is cheap, and
+# writing it before responding means every worker sees the payment at once.
+# Database errors propagate so a payment is never reported as created unsaved.
+def save_payment(payment: Dict) -> None:
+    row = {column: payment.get(column) for column in PAYMENT_COLUMNS}
+    with get_db() as conn, conn:
+        conn.execute(SAVE_PAYMENT_SQL, row)
+
+# Function to update a payment's status. This is an indexed primary-key write,
+# done synchronously so the webhook only acknowledges a stored confirmation.
+# Database errors propagate so the caller can answer with a non-2xx status.
+def update_payment_status(payment_id: str, status: str, completed_at: Optional[str] = None) -> bool:
+    with get_db() as conn, conn:
+        cursor = conn.execute(
+            'UPDATE payments SET status = ?, completed_at = ? WHERE id = ?',
+            (status, completed_at, payment_id)
+        )
+    return cursor.rowcount > 0
 
 # Function to validate payment amount
 def validate_payment_amount(amount: float, currency: str) -> bool:
@@ -173,114 +579,305 @@ def validate_payment_amount(amount: float, currency: str) -> bool:
     except (ValueError, TypeError):
         return False
 
+# Function to derive a stable customer id from an email, cached for repeat customers
+@lru_cache(maxsize=10000)
+def get_customer_id(email: str) -> str:
+    return hashlib.blake2b(email.encode(), digest_size=16).hexdigest()
+
 # Function to generate payment hash for security
 def generate_payment_hash(payment_info: PaymentInfo) -> str:
     data = f"{payment_info.id}{payment_info.amount}{payment_info.currency}{payment_info.crypto}"
     return hashlib.sha256(data.encode()).hexdigest()
 
+# QR code settings shared by every rendered format
+QR_OPTIONS = {
+    'version': None,
+    'box_size': 10,
+    'border': 5,
+    'error_correction': qrcode.constants.ERROR_CORRECT_L
+}
+
+# Function to build the QR matrix for a payment URL
+def build_qr(url: str, image_factory=None) -> qrcode.QRCode:
+    qr = qrcode.QRCode(image_factory=image_factory, **QR_OPTIONS)
+    qr.add_data(url)
+    qr.make(fit=True)
+    return qr
+
+# Function to render a payment URL as a PNG QR code, cached per URL
+@lru_cache(maxsize=1024)
+def render_qr_png(url: str) -> bytes:
+    img = build_qr(url).make_image(fill_color="black", back_color="white")
+
+    # Save QR code to bytes
+    img_byte_arr = BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+# Function to render a payment URL as an SVG QR code without going through PIL
+@lru_cache(maxsize=1024)
+def render_qr_svg(url: str) -> str:
+    img = build_qr(url, image_factory=qrcode.image.svg.SvgPathImage).make_image()
+    svg_bytes = BytesIO()
+    img.save(svg_bytes)
+    return svg_bytes.getvalue().decode('utf-8')
+
+# Serialize a constant JSON payload once; returns the body and its ETag
+def build_static_json(payload: Dict) -> Tuple[bytes, str]:
+    body = orjson.dumps(payload)
+    return body, hashlib.blake2b(body, digest_size=8).hexdigest()
+
+# Serve a precomputed JSON body, answering 304 when the client's copy is current
+def static_json_response(body: bytes, etag: str) -> Response:
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
+
+# Precomputed responses for endpoints that only return constants
+CURRENCIES_BODY, CURRENCIES_ETAG = build_static_json({
+    'success': True,
+    'currencies': SUPPORTED_CURRENCIES,
+    'cryptos': SUPPORTED_CRYPTOS
+})
+CRYPTO_RATES_BODY, CRYPTO_RATES_ETAG = build_static_json({'success': True, 'rates': CRYPTO_RATES})
+
 # Route to get supported currencies and cryptos
 @app.route('/get_currencies', methods=['GET'])
 @rate_limit
 def get_currencies():
     try:
-        return jsonify({
-            'success': True,
-            'currencies': SUPPORTED_CURRENCIES,
-            'cryptos': SUPPORTED_CRYPTOS
-        })
+        return static_json_response(CURRENCIES_BODY, CURRENCIES_ETAG)
     except Exception as e:
         logger.error(f"Error in get_currencies: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Function to validate a payment request; returns the payment fields or an error message
+def parse_payment_request(data: Dict) -> Tuple[Optional[Dict], Optional[str]]:
+    if not isinstance(data, dict):
+        return None, 'Invalid payment request'
+    amount = data.get('amount', 0)
+    currency = data.get('currency', 'USD')
+    crypto = data.get('crypto', 'BTC')
+
+    # Validate inputs
+    if not validate_payment_amount(amount, currency):
+        return None, 'Invalid amount'
+
+    if crypto not in SUPPORTED_CRYPTOS:
+        return None, 'Unsupported cryptocurrency'
+
+    if currency not in SUPPORTED_CURRENCIES:
+        return None, 'Unsupported currency'
+
+    # Get current exchange rate; None (not a guessed 1.0) when no rate is known yet
+    exchange_rates = get_exchange_rates()
+
+    return {
+        'amount': float(amount),
+        'currency': currency,
+        'crypto': crypto,
+        'customer_email': data.get('customer_email'),
+        'description': data.get('description', f'Payment in {SUPPORTED_CRYPTOS[crypto]["name"]}'),
+        'exchange_rate': exchange_rates.get(currency)
+    }, None
+
+# Function to create a Coinbase charge on the thread pool
+def submit_charge(payment: Dict) -> Future:
+    customer_email = payment['customer_email']
+    return coinbase_pool.submit(
+        client.charge.create,
+        name='Payment',
+        description=payment['description'],
+        pricing_type='fixed_price',
+        local_price={
+            'amount': str(payment['amount']),
+            'currency': payment['currency']
+        },
+        metadata={
+            'customer_id': get_customer_id(customer_email) if customer_email else 'anonymous',
+            'customer_email': customer_email,
+            'crypto': payment['crypto'],
+            'currency': payment['currency'],
+            'exchange_rate': payment['exchange_rate']
+        }
+    )
+
+# Function to store a created charge in the payment history
+def store_payment(payment: Dict, charge) -> Dict:
+    # Create payment info
+    payment_info = PaymentInfo(
+        id=charge['id'],
+        amount=payment['amount'],
+        currency=payment['currency'],
+        crypto=payment['crypto'],
+        status=PaymentStatus.PENDING,
+        timestamp=datetime.now(),
+        payment_url=charge['hosted_url'],
+        exchange_rate=payment['exchange_rate'],
+        customer_email=payment['customer_email'],
+        description=payment['description']
+    )
+
+    # Save payment to history
+    record = asdict(payment_info)
+    record['status'] = payment_info.status.value
+    record['timestamp'] = payment_info.timestamp.isoformat()
+    save_payment(record)
+    return record
+
+# Function to store a created charge and build its API response
+def record_payment(payment: Dict, charge) -> Dict:
+    record = store_payment(payment, charge)
+
+    # Generate QR code
+    img_byte_arr = render_qr_png(charge['hosted_url'])
+
+    return {
+        'success': True,
+        'payment_url': charge['hosted_url'],
+        'qr_code': base64.b64encode(img_byte_arr).decode('ascii'),
+        'qr_code_url': url_for('get_qr_code', cid=charge['id']),
+        'qr_code_svg_url': url_for('get_qr_code_svg', cid=charge['id']),
+        'payment_info': record
+    }
+
+# Function to handle a charge whose request stopped waiting for it. A charge
+# still queued is cancelled; one already sent to Coinbase is stored when it
+# completes, so its confirmation webhook finds it.
+def save_late_charge(payment: Dict, future: Future) -> None:
+    if future.cancel():
+        return
+
+    def on_done(done: Future) -> None:
+        if done.exception() is not None:
+            return
+        charge = done.result()
+        try:
+            store_payment(payment, charge)
+            logger.warning(f"Stored charge {charge['id']} that completed after its request timed out")
+        except Exception as e:
+            logger.error(f"Error storing late charge {charge['id']}: {str(e)}")
+
+    future.add_done_callback(on_done)
+
 # Route to create a new payment
 @app.route('/create_payment', methods=['POST'])
 @rate_limit
 def create_payment():
     try:
         # Validate request data
-        data = request.json
-        amount = float(data.get('amount', 0))
-        currency = data.get('currency', 'USD')
-        crypto = data.get('crypto', 'BTC')
-        customer_email = data.get('customer_email')
-        description = data.get('description', f'Payment in {SUPPORTED_CRYPTOS[crypto]["name"]}')
-
-        # Validate inputs
-        if not validate_payment_amount(amount, currency):
-            return jsonify({'success': False, 'error': 'Invalid amount'}), 400
-        
-        if crypto not in SUPPORTED_CRYPTOS:
-            return jsonify({'success': False, 'error': 'Unsupported cryptocurrency'}), 400
-        
-        if currency not in SUPPORTED_CURRENCIES:
-            return jsonify({'success': False, 'error': 'Unsupported currency'}), 400
-
-        # Get current exchange rate
-        exchange_rates = get_exchange_rates()
-        exchange_rate = exchange_rates.get(currency, 1.0)
+        payment, error = parse_payment_request(request.json)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
 
         # Create payment charge
-        charge = client.charge.create(
-            name='Payment',
-            description=description,
-            pricing_type='fixed_price',
-            local_price={
-                'amount': str(amount),
-                'currency': currency
-            },
-            metadata={
-                'customer_id': hashlib.md5(customer_email.encode()).hexdigest() if customer_email else 'anonymous',
-                'customer_email': customer_email,
-                'crypto': crypto,
-                'currency': currency,
-                'exchange_rate': exchange_rate
-            }
-        )
+        future = submit_charge(payment)
+        try:
+            charge = future.result(timeout=COINBASE_TIMEOUT)
+        except FuturesTimeoutError:
+            logger.error("Timed out creating charge in create_payment")
+            save_late_charge(payment, future)
+            return jsonify({'success': False, 'error': 'Payment provider timed out'}), 504
 
-        # Generate QR code
-        qr = qrcode.QRCode(
-            version=1,
-            box_size=10,
-            border=5,
-            error_correction=qrcode.constants.ERROR_CORRECT_L
-        )
-        qr.add_data(charge['hosted_url'])
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Save QR code to bytes
-        img_byte_arr = BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-
-        # Create payment info
-        payment_info = PaymentInfo(
-            id=charge['id'],
-            amount=amount,
-            currency=currency,
-            crypto=crypto,
-            status=PaymentStatus.PENDING,
-            timestamp=datetime.now(),
-            payment_url=charge['hosted_url'],
-            exchange_rate=exchange_rate,
-            customer_email=customer_email,
-            description=description
-        )
+        try:
+            return jsonify(record_payment(payment, charge))
+        except sqlite3.Error as e:
+            logger.error(f"Error storing charge {charge['id']} in create_payment: {str(e)}")
+            return jsonify({'success': False, 'error': 'Payment could not be stored'}), 500
+
+    except Exception as e:
+        logger.error(f"Error in create_payment: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # Save payment to history
-        history = load_payment_history()
-        history.append(payment_info.__dict__)
-        save_payment_history(history)
+# Route to create several payments with concurrent Coinbase calls
+@app.route('/create_payments_batch', methods=['POST'])
+@rate_limit
+def create_payments_batch():
+    try:
+        # Validate request data
+        data = request.json
+        items = data.get('payments') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not 0 < len(items) <= BATCH_MAX_PAYMENTS:
+            return jsonify({
+                'success': False,
+                'error': f'payments must be a list of 1 to {BATCH_MAX_PAYMENTS} payments'
+            }), 400
+
+        payments = []
+        for index, item in enumerate(items):
+            payment, error = parse_payment_request(item)
+            if error:
+                return jsonify({'success': False, 'error': f'Payment {index}: {error}'}), 400
+            payments.append(payment)
+
+        # Each charge costs one rate-limit token; @rate_limit already took one
+        if len(payments) > 1 and not consume_token(request.remote_addr, time.time(), len(payments) - 1):
+            return jsonify({'error': 'Rate limit exceeded'}), 429
+
+        # Create all charges at once and wait for them under one shared deadline
+        futures = [submit_charge(payment) for payment in payments]
+        _, not_done = wait(futures, timeout=COINBASE_TIMEOUT)
+        results = []
+        for payment, future in zip(payments, futures):
+            if future in not_done:
+                save_late_charge(payment, future)
+                results.append({'success': False, 'error': 'Payment provider timed out'})
+                continue
+            try:
+                charge = future.result()
+            except Exception as e:
+                logger.error(f"Error in create_payments_batch: {str(e)}")
+                results.append({'success': False, 'error': str(e)})
+                continue
+            try:
+                results.append(record_payment(payment, charge))
+            except sqlite3.Error as e:
+                logger.error(f"Error storing charge {charge['id']} in create_payments_batch: {str(e)}")
+                results.append({'success': False, 'error': 'Payment could not be stored'})
+            except Exception as e:
+                logger.error(f"Error in create_payments_batch: {str(e)}")
+                results.append({'success': False, 'error': str(e)})
+
+        return jsonify({'success': True, 'payments': results})
 
-        return jsonify({
-            'success': True,
-            'payment_url': charge['hosted_url'],
-            'qr_code': img_byte_arr.hex(),
-            'payment_info': payment_info.__dict__
-        })
+    except Exception as e:
+        logger.error(f"Error in create_payments_batch: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Route to serve a payment's QR code as a cacheable PNG
+@app.route('/qr/<cid>.png', methods=['GET'])
+@rate_limit
+def get_qr_code(cid):
+    try:
+        payment = load_payment(cid)
+        if not payment or not payment['payment_url']:
+            return jsonify({'success': False, 'error': 'Payment not found'}), 404
+        return Response(
+            render_qr_png(payment['payment_url']),
+            mimetype='image/png',
+            headers={'Cache-Control': 'public, max-age=31536000, immutable'}
+        )
+    except Exception as e:
+        logger.error(f"Error in get_qr_code: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
+# Route to serve a payment's QR code as a cacheable SVG
+@app.route('/qr/<cid>.svg', methods=['GET'])
+@rate_limit
+def get_qr_code_svg(cid):
+    try:
+        payment = load_payment(cid)
+        if not payment or not payment['payment_url']:
+            return jsonify({'success': False, 'error': 'Payment not found'}), 404
+        return Response(
+            render_qr_svg(payment['payment_url']),
+            mimetype='image/svg+xml',
+            headers={'Cache-Control': 'public, max-age=31536000, immutable'}
+        )
     except Exception as e:
-        logger.error(f"Error in create_payment: {str(e)}")
+        logger.error(f"Error in get_qr_code_svg: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 # Route to get payment history
@@ -289,10 +886,33 @@ def create_payment():
 @token_required
 def get_payment_history(current_user):
     try:
-        history = load_payment_history()
+        try:
+            limit = min(int(request.args.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE)
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid pagination parameters'}), 400
+        if limit < 1 or offset < 0:
+            return jsonify({'success': False, 'error': 'Invalid pagination parameters'}), 400
+
+        # Keyset cursor: before and before_id come together and replace offset
+        before = None
+        if 'before' in request.args or 'before_id' in request.args:
+            if 'before' not in request.args or 'before_id' not in request.args:
+                return jsonify({'success': False, 'error': 'before and before_id must be sent together'}), 400
+            if 'offset' in request.args:
+                return jsonify({'success': False, 'error': 'offset cannot be combined with before'}), 400
+            before = (request.args['before'], request.args['before_id'])
+
+        history = load_payment_history(limit, offset, before)
+        next_before = None
+        if len(history) == limit:
+            next_before = {'before': history[-1]['timestamp'], 'before_id': history[-1]['id']}
         return jsonify({
             'success': True,
-            'history': history
+            'history': history,
+            'limit': limit,
+            'offset': offset,
+            'next_before': next_before
         })
     except Exception as e:
         logger.error(f"Error in get_payment_history: {str(e)}")
@@ -312,16 +932,15 @@ def webhook():
         if event.type == 'charge:confirmed':
             # Handle successful payment
             charge = event.data
-            history = load_payment_history()
-            
-            # Update payment status
-            for payment in history:
-                if payment['id'] == charge['id']:
-                    payment['status'] = PaymentStatus.COMPLETED.value
-                    payment['completed_at'] = datetime.now().isoformat()
-                    break
-            
-            save_payment_history(history)
+
+            # Update payment status before acknowledging; a database error
+            # returns 500 so Coinbase redelivers the event
+            if not update_payment_status(
+                charge['id'],
+                PaymentStatus.COMPLETED.value,
+                datetime.now().isoformat()
+            ):
+                logger.warning(f"Confirmed payment not found in history: {charge['id']}")
             logger.info(f"Payment confirmed: {charge['id']}")
         
         return jsonify({'success': True})
@@ -334,11 +953,11 @@ def webhook():
 @rate_limit
 def get_exchange_rate():
     try:
-        rates = get_exchange_rates()
+        timestamp, rates = _rates_cache
         return jsonify({
             'success': True,
             'rates': rates,
-            'timestamp': exchange_rate_cache['timestamp']
+            'timestamp': timestamp
         })
     except Exception as e:
         logger.error(f"Error in get_exchange_rate: {str(e)}")
@@ -349,34 +968,21 @@ def get_exchange_rate():
 @rate_limit
 def get_crypto_rates():
     try:
-        # This is a placeholder. In production, you would fetch real-time crypto rates
-        # from a reliable API like Coinbase Pro or CoinGecko
-        rates = {
-            'BTC': 50000.0,
-            'ETH': 3000.0,
-            'USDC': 1.0,
-            'LTC': 150.0,
-            'BCH': 500.0,
-            'XRP': 0.5,
-            'DOGE': 0.1,
-            'DOT': 20.0,
-            'ADA': 1.5,
-            'SOL': 100.0,
-            'AVAX': 50.0,
-            'MATIC': 2.0,
-            'LINK': 20.0,
-            'UNI': 10.0,
-            'AAVE': 200.0
-        }
-        return jsonify({'success': True, 'rates': rates})
+        return static_json_response(CRYPTO_RATES_BODY, CRYPTO_RATES_ETAG)
     except Exception as e:
         logger.error(f"Error in get_crypto_rates: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Prepare payment storage and start background workers
+init_db()
+atexit.register(close_db)
+start_exchange_rate_refresher()
+
 # Main route
 @app.route('/')
 def home():
     return render_template('index.html')
 
-if __name__ == '__main__':
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
+if __name__ == '__main__' and os.getenv('FLASK_ENV') == 'dev':
     app.run(debug=True)
@@ -0,0 +1,15 @@
+# Gunicorn configuration for production
+# Run with: gunicorn -c gunicorn.conf.py cryp:app
+# Requires the gunicorn and gevent packages (see README).
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+
+# gevent workers make network I/O cooperative, so calls to Coinbase, Redis and
+# the exchange rate API overlap within a worker. sqlite3 calls are not patched:
+# they block the worker's hub, including SQLite's busy-wait when workers contend
+# for the database. Background "threads" in cryp.py are greenlets on that same hub.
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_connections = 1000
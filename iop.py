@@ -5,7 +5,10 @@ from dotenv import load_dotenv
 import os
 import qrcode
 from io import BytesIO
+import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 
@@ -17,6 +20,13 @@ client = Client(api_key=os.getenv('COINBASE_API_KEY'))
 # Exchange rate API endpoint
 EXCHANGE_RATE_API = "https://api.exchangerate-api.com/v4/latest/USD"
 
+# Shared HTTP session so exchange rate lookups reuse pooled keep-alive connections
+http = requests.Session()
+http.mount('https://', HTTPAdapter(
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+))
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -56,7 +66,7 @@ def create_payment():
         return jsonify({
             'success': True,
             'payment_url': charge['hosted_url'],
-            'qr_code': img_byte_arr.hex()
+            'qr_code': base64.b64encode(img_byte_arr).decode('ascii')
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -64,7 +74,7 @@ def create_payment():
 @app.route('/get_exchange_rate', methods=['GET'])
 def get_exchange_rate():
     try:
-        response = requests.get(EXCHANGE_RATE_API)
+        response = http.get(EXCHANGE_RATE_API, timeout=(2, 5))
         rates = response.json()['rates']
         return jsonify({'success': True, 'rates': rates})
     except Exception as e:
@@ -90,5 +100,6 @@ def webhook():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-if __name__ == '__main__':
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
+if __name__ == '__main__' and os.getenv('FLASK_ENV') == 'dev':
     app.run(debug=True) 